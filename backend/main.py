@@ -1,19 +1,48 @@
-from typing import List, Optional, Dict, Any, Callable
+from typing import List, Optional, Dict, Any, Callable, AsyncIterator, Union
 from pydantic import BaseModel, Field
+from dataclasses import dataclass, field
+from collections import deque
+from itertools import islice
 from datetime import datetime
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Response
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
 import openai
-import requests
+import httpx
+import orjson
+import redis.asyncio as redis
+import zstandard
+import asyncio
+import logging
 import os
-import json
+import re
+import sqlite3
+import struct
+import threading
+import time
 from dotenv import load_dotenv
-from functools import wraps
+from functools import wraps, lru_cache
+from cachetools import TTLCache
+from aiolimiter import AsyncLimiter
+
+logger = logging.getLogger(__name__)
 
 # Load environment variables
 load_dotenv()
 gemini_api_key = os.getenv("GEMINI_API_KEY")
 OPENWEATHER_API_KEY = os.getenv("OPENWEATHER_API_KEY")
+REDIS_URL = os.getenv("REDIS_URL")
+# SQLite file used as the second cache layer when Redis is not configured; empty disables it
+CACHE_DB_PATH = os.getenv("CACHE_DB_PATH", "weather_cache.sqlite")
+# Oldest conversation turns are dropped beyond this many entries
+HISTORY_MAX_ENTRIES = int(os.getenv("HISTORY_MAX_ENTRIES", "1000"))
+# Model that turns tool results into the final reply; routing stays on the agent's own model
+SUMMARIZER_MODEL = os.getenv("SUMMARIZER_MODEL", "gemini-2.0-flash-lite")
+# Budget for the serialized context in the system prompt; oldest history is dropped to fit
+CONTEXT_MAX_CHARS = int(os.getenv("CONTEXT_MAX_CHARS", "4000"))
 
 if not gemini_api_key:
     raise ValueError("GEMINI_API_KEY is not set.")
@@ -21,27 +50,578 @@ if not OPENWEATHER_API_KEY:
     raise ValueError("OPENWEATHER_API_KEY is not set.")
 
 # Gemini OpenAI-compatible setup
-openai.api_key = gemini_api_key
-openai.base_url = "https://generativelanguage.googleapis.com/v1beta/openai/"
+llm_client = openai.AsyncOpenAI(
+    api_key=gemini_api_key,
+    base_url="https://generativelanguage.googleapis.com/v1beta/openai/",
+)
+
+# OpenWeather endpoints
+CURRENT_WEATHER_URL = "https://api.openweathermap.org/data/2.5/weather"
+FORECAST_URL = "https://api.openweathermap.org/data/2.5/forecast"
+AIR_POLLUTION_URL = "https://api.openweathermap.org/data/2.5/air_pollution"
+GEOCODING_URL = "https://api.openweathermap.org/geo/1.0/direct"
+
+# Shared OpenWeather HTTP client, opened once per process in the app lifespan
+http_client: Optional[httpx.AsyncClient] = None
+
+# Per-worker budget of outbound OpenWeather calls per minute (free tier allows 60)
+OPENWEATHER_CALLS_PER_MINUTE = int(os.getenv("OPENWEATHER_CALLS_PER_MINUTE", "60"))
+_upstream_limiter = AsyncLimiter(OPENWEATHER_CALLS_PER_MINUTE, 60)
+
+# Optional Redis shared by all workers as a second cache layer; None when REDIS_URL is unset
+redis_client: Optional[redis.Redis] = None
+
+class SQLiteCache:
+    """File-backed second cache layer for single-host deployments without Redis.
+
+    Survives restarts and is shared by workers on the same machine. Methods are
+    blocking and are called through asyncio.to_thread.
+    """
+
+    # Wait this long (seconds) for another worker's write lock before failing with "database is locked"
+    BUSY_TIMEOUT = 5.0
+    # Expired rows are purged on write at most this often (seconds)
+    PURGE_INTERVAL = 300
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            path, timeout=self.BUSY_TIMEOUT, check_same_thread=False, isolation_level=None
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, fresh_until REAL NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS locks (key TEXT PRIMARY KEY, expires_at REAL NOT NULL)")
+        self._next_purge = 0.0
+        self._purge(time.time())
+
+    def _purge(self, now: float):
+        # Caller holds self._lock (or is __init__)
+        self._conn.execute("DELETE FROM cache WHERE expires_at < ?", (now,))
+        self._conn.execute("DELETE FROM locks WHERE expires_at < ?", (now,))
+        self._next_purge = now + self.PURGE_INTERVAL
+
+    def get(self, key: str) -> tuple:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, fresh_until FROM cache WHERE key = ? AND expires_at > ?", (key, time.time())
+            ).fetchone()
+        if row is None:
+            return None, False
+        return row[0], row[1] > time.time()
+
+    def set(self, key: str, value: bytes, ttl: int, stale_ttl: Optional[int]):
+        now = time.time()
+        expires_at = now + stale_ttl if stale_ttl is not None else float("inf")
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)", (key, value, now + ttl, expires_at)
+            )
+            if now >= self._next_purge:
+                self._purge(now)
+
+    def try_lock(self, key: str, ttl: int) -> bool:
+        now = time.time()
+        with self._lock:
+            self._conn.execute("DELETE FROM locks WHERE key = ? AND expires_at < ?", (key, now))
+            return self._conn.execute("INSERT OR IGNORE INTO locks VALUES (?, ?)", (key, now + ttl)).rowcount == 1
+
+    def close(self):
+        self._conn.close()
+
+# Used only when Redis is not configured
+sqlite_cache: Optional[SQLiteCache] = None
+
+# Default in-process (L1) response cache TTLs in seconds, overridable per agent.
+# OpenWeather refreshes current conditions every ~10 min, air quality hourly and
+# forecasts every 3h. The same TTLs mark Redis (L2) entries fresh; L2 keeps the
+# value around for STALE_TTL so expired entries can be served while a refresh runs;
+# L1 does the same for one extra TTL (see SWRCache).
+CURRENT_TTL = int(os.getenv("CURRENT_TTL", "600"))
+FORECAST_TTL = int(os.getenv("FORECAST_TTL", "3600"))
+AIR_QUALITY_TTL = int(os.getenv("AIR_QUALITY_TTL", "1800"))
+STALE_TTL = 86400
+REFRESH_LOCK_TTL = 5
+
+# City name -> (lat, lon); coordinates effectively never change, so L2 keeps them
+# without expiry and the in-process copy only bounds memory
+GEOCODE_TTL = 86400
+_geocode_cache = TTLCache(maxsize=4096, ttl=GEOCODE_TTL)
+
+# Redis keys holding agent state shared by all workers: hashes with one field per key,
+# the conversation as a capped list of JSON turns, and its counters
+PREFERENCES_KEY = "ww:state:preferences"
+SAVED_LOCATIONS_KEY = "ww:state:locations"
+HISTORY_KEY = "ww:state:history"
+CONVERSATION_COUNT_KEY = "ww:state:conversation_count"
+LAST_INTERACTION_KEY = "ww:state:last_interaction"
+# Turns included in the chat context, and pulled from Redis before each chat message
+RECENT_HISTORY_LIMIT = 5
+# Weather routes re-read preferences from Redis at most this often (seconds), so cache hits
+# do not pay a Redis round trip; a units change made on another worker shows up within it
+STATE_SYNC_INTERVAL = float(os.getenv("STATE_SYNC_INTERVAL", "5"))
+
+# Coordinates are rounded to 3 decimals (~100 m) so nearby points share cache entries
+COORD_PRECISION = 3
+
+def _normalize_location(location: str) -> str:
+    # Cache key: "New York,US", "new york, us" and " New  York , US" all map to "new york,us"
+    coords = _parse_location(location)
+    if "lat" in coords:
+        return f"{coords['lat']},{coords['lon']}"
+    return ",".join(" ".join(part.split()) for part in location.lower().split(","))
+
+_COORD_RE = re.compile(r"^\s*(-?\d+(?:\.\d+)?)\s*,\s*(-?\d+(?:\.\d+)?)\s*$")
+
+@lru_cache(maxsize=2048)
+def _parse_location(location: str) -> Dict[str, Any]:
+    # Cached and shared between callers: treat the returned dict as read-only
+    match = _COORD_RE.match(location)
+    if match:
+        return {
+            "lat": round(float(match.group(1)), COORD_PRECISION),
+            "lon": round(float(match.group(2)), COORD_PRECISION),
+        }
+    return {"q": location.strip()}
+
+# Upstream answers worth retrying, with exponential backoff between attempts
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.2
+
+class CircuitBreaker:
+    """Stops calling a failing upstream for reset_timeout seconds after fail_max consecutive failures.
+
+    Once the cooldown is over the breaker is half-open: exactly one probe call is let through.
+    Its success closes the circuit, its failure reopens it for another cooldown. A probe that
+    never reports back is replaced by a new one after reset_timeout.
+    """
+
+    def __init__(self, fail_max: int = 5, reset_timeout: float = 60):
+        self.fail_max = fail_max
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._probe_started: Optional[float] = None
+
+    def allow_request(self) -> bool:
+        if self._opened_at is None:
+            return True
+        now = time.monotonic()
+        if now - self._opened_at < self.reset_timeout:
+            return False
+        if self._probe_started is not None and now - self._probe_started < self.reset_timeout:
+            return False
+        self._probe_started = now
+        return True
+
+    def record_success(self):
+        self._failures = 0
+        self._opened_at = None
+        self._probe_started = None
+
+    def record_failure(self):
+        self._failures += 1
+        if self._probe_started is not None or self._failures >= self.fail_max:
+            self._opened_at = time.monotonic()
+            self._probe_started = None
+
+# One breaker per upstream endpoint, so a failing air-pollution API does not cut off weather
+_upstream_breakers = {
+    url: CircuitBreaker() for url in (CURRENT_WEATHER_URL, FORECAST_URL, AIR_POLLUTION_URL, GEOCODING_URL)
+}
+
+# Last 200 body per request with its ETag/Last-Modified: lets refetches be conditional and
+# is what gets served while the circuit breaker is open or the call budget is spent
+_last_responses = TTLCache(maxsize=2048, ttl=STALE_TTL)
+
+# Set in the current task when _get_json answered from _last_responses instead of calling the
+# upstream; that body may be hours old, so results built from it are returned but not cached
+_served_stale: ContextVar[bool] = ContextVar("served_stale", default=False)
+
+async def _get_json(url: str, params: Dict[str, Any]) -> tuple:
+    """GET an OpenWeather endpoint; return (status_code, body), decoding the body once and only on 200.
+
+    A 304 Not Modified answer to a conditional request is reported as 200 with the previous body.
+    So is a call made while the upstream circuit is open (503 if there is no previous body) or
+    while the per-minute budget is spent, rather than waiting for the limiter.
+    """
+    response_key = (url, tuple(sorted(params.items())))
+    previous = _last_responses.get(response_key)
+    if previous is not None and not _upstream_limiter.has_capacity():
+        _served_stale.set(True)
+        return 200, orjson.loads(previous[2])
+    breaker = _upstream_breakers[url]
+    if not breaker.allow_request():
+        if previous is None:
+            return 503, None
+        _served_stale.set(True)
+        return 200, orjson.loads(previous[2])
+
+    headers = {}
+    if previous is not None:
+        etag, last_modified, _ = previous
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+
+    # One token per logical call; retries of that call do not spend more of the budget
+    await _upstream_limiter.acquire()
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            response = await http_client.get(url, params=params, headers=headers)
+        except httpx.TransportError:
+            if attempt == MAX_RETRIES:
+                breaker.record_failure()
+                raise
+        else:
+            if response.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                break
+        await asyncio.sleep(RETRY_BACKOFF * 2 ** attempt)
+
+    if response.status_code in RETRY_STATUSES:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+    if response.status_code == 304 and previous is not None:
+        # Re-insert so a body that keeps revalidating does not age out of the cache
+        _last_responses[response_key] = previous
+        return 200, orjson.loads(previous[2])
+    if response.status_code != 200:
+        return response.status_code, None
+
+    _last_responses[response_key] = (response.headers.get("ETag"), response.headers.get("Last-Modified"), response.content)
+    return 200, orjson.loads(response.content)
+
+@dataclass(slots=True, frozen=True)
+class CurrentWeather:
+    """Current conditions as cached and returned by get_current_weather; orjson serializes it directly."""
+    temperature: float
+    feels_like: float
+    humidity: int
+    description: str
+    wind_speed: float
+
+# Compact Redis encoding for current weather: temperature, feels_like and wind_speed
+# in tenths (int16/int16/uint16), humidity as uint8, then the UTF-8 description.
+_CURRENT_STRUCT = struct.Struct("<hhBH")
+
+def _pack_current(result: CurrentWeather) -> bytes:
+    return _CURRENT_STRUCT.pack(
+        round(result.temperature * 10),
+        round(result.feels_like * 10),
+        result.humidity,
+        round(result.wind_speed * 10),
+    ) + result.description.encode()
+
+def _unpack_current(raw: bytes) -> CurrentWeather:
+    temperature, feels_like, humidity, wind_speed = _CURRENT_STRUCT.unpack_from(raw)
+    return CurrentWeather(
+        temperature=temperature / 10,
+        feels_like=feels_like / 10,
+        humidity=humidity,
+        description=raw[_CURRENT_STRUCT.size:].decode(),
+        wind_speed=wind_speed / 10
+    )
+
+# Forecast blobs are the largest cache entries; zstd keeps Redis memory and transfer small
+_zstd_compressor = zstandard.ZstdCompressor(level=3)
+_zstd_decompressor = zstandard.ZstdDecompressor()
+
+def _pack_forecast(result: Dict[str, Any]) -> bytes:
+    return _zstd_compressor.compress(orjson.dumps(result))
+
+def _unpack_forecast(raw: bytes) -> Dict[str, Any]:
+    return orjson.loads(_zstd_decompressor.decompress(raw))
+
+def _prune_forecast_entry(entry: Dict[str, Any]) -> Dict[str, Any]:
+    # Keep only the fields clients render; OpenWeather sends many more per 3h slot
+    weather = entry["weather"][0]
+    return {
+        "dt": entry["dt"],
+        "main": {
+            "temp": entry["main"]["temp"],
+            "feels_like": entry["main"]["feels_like"],
+            "humidity": entry["main"]["humidity"]
+        },
+        "weather": [{"main": weather["main"], "description": weather["description"], "icon": weather["icon"]}],
+        "wind": {"speed": entry["wind"]["speed"]}
+    }
+
+# Strong references to background refreshes so they are not garbage collected mid-flight
+_background_tasks: set = set()
+
+# Upstream fetches currently in progress, so concurrent misses on one key share a single call
+_inflight: Dict[str, asyncio.Task] = {}
+
+def _log_task_failure(task: asyncio.Task):
+    # Fire-and-forget tasks have no caller to report to, so failures are logged here
+    # (which also keeps asyncio from warning "Task exception was never retrieved")
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning("Background task %s failed", task.get_name(), exc_info=task.exception())
+
+def _mark_task_failure_retrieved(task: asyncio.Task):
+    # Awaited tasks: callers already get the exception; this only silences asyncio's
+    # warning when every caller went away before the task finished
+    if not task.cancelled():
+        task.exception()
+
+def _spawn(coro, awaited: bool = False) -> asyncio.Task:
+    """Run coro as a strongly referenced task; pass awaited=True when callers receive its outcome."""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    task.add_done_callback(_mark_task_failure_retrieved if awaited else _log_task_failure)
+    return task
+
+async def _l2_get(key: str) -> tuple:
+    """Return (value, is_fresh) from the second cache layer; (None, False) on a miss or when it is unavailable."""
+    if redis_client is None:
+        if sqlite_cache is not None:
+            try:
+                return await asyncio.to_thread(sqlite_cache.get, key)
+            except sqlite3.Error:
+                # e.g. "database is locked" under many workers: treat as a miss, like a Redis outage
+                pass
+        return None, False
+    try:
+        value, fresh = await redis_client.mget(f"{key}:val", f"{key}:fresh")
+    except redis.RedisError:
+        # A Redis outage degrades to L1 + upstream rather than failing the request
+        return None, False
+    return value, fresh is not None
+
+async def _l2_set(key: str, value: bytes, ttl: int, stale_ttl: Optional[int] = STALE_TTL):
+    """Store value, fresh for ttl seconds and kept for stale_ttl (None keeps it indefinitely)."""
+    if redis_client is None:
+        if sqlite_cache is not None:
+            try:
+                await asyncio.to_thread(sqlite_cache.set, key, value, ttl, stale_ttl)
+            except sqlite3.Error:
+                pass
+        return
+    try:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.set(f"{key}:val", value, ex=stale_ttl)
+            pipe.set(f"{key}:fresh", 1, ex=ttl)
+            await pipe.execute()
+    except redis.RedisError:
+        pass
+
+async def _l2_try_lock(key: str) -> bool:
+    # Only one worker refetches a given key at a time
+    if redis_client is not None:
+        return bool(await redis_client.set(f"ww:lock:{key}", 1, nx=True, ex=REFRESH_LOCK_TTL))
+    if sqlite_cache is None:
+        return True
+    return await asyncio.to_thread(sqlite_cache.try_lock, key, REFRESH_LOCK_TTL)
+
+class SWRCache(TTLCache):
+    """In-process (L1) cache whose entries stay servable for a grace period after going stale.
+
+    Entries are fresh for fresh_ttl seconds; during the following grace seconds (default: another
+    fresh_ttl) lookups still return them, flagged stale, so the caller can refresh in the background.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, grace: Optional[float] = None):
+        super().__init__(maxsize=maxsize, ttl=ttl + (ttl if grace is None else grace))
+        self.fresh_ttl = ttl
+
+    def lookup(self, key: str) -> tuple:
+        """Return (entry, is_fresh); (None, False) on a miss."""
+        item = self.get(key)
+        if item is None:
+            return None, False
+        entry, fresh_until = item
+        return entry, self.timer() < fresh_until
+
+    def put(self, key: str, entry: tuple):
+        self[key] = (entry, self.timer() + self.fresh_ttl)
+
+def _entry(result: Any) -> tuple:
+    # L1 keeps the JSON body next to the dict so route handlers can send it without re-encoding
+    return result, orjson.dumps(result)
+
+async def _store(cache: SWRCache, key: str, entry: tuple, encode: Callable):
+    result = entry[0]
+    # Errors are not cached so a transient upstream failure is retried next call
+    if not isinstance(result, dict) or "error" not in result:
+        cache.put(key, entry)
+        await _l2_set(key, encode(result), int(cache.fresh_ttl))
+
+async def _fetch_and_store(cache: SWRCache, key: str, fetch: Callable, encode: Callable) -> tuple:
+    # Shared by cold misses and background refreshes so both join one in-flight fetch per key
+    async def fetch_and_store():
+        _served_stale.set(False)
+        entry = _entry(await fetch())
+        if not _served_stale.get():
+            await _store(cache, key, entry, encode)
+        return entry
+
+    return await _single_flight(key, fetch_and_store)
+
+async def _refresh(
+    cache: SWRCache, key: str, fetch: Callable, encode: Callable, decode: Optional[Callable] = None
+):
+    """Refetch key in the background. With decode, first adopt a fresh L2 copy if another worker made one."""
+    # Already being fetched in this worker, or out of upstream budget: keep serving the stale copy
+    if key in _inflight or not _upstream_limiter.has_capacity():
+        return
+    try:
+        if decode is not None:
+            raw, fresh = await _l2_get(key)
+            if fresh:
+                cache.put(key, _entry(decode(raw)))
+                return
+        if not await _l2_try_lock(key):
+            return
+        await _fetch_and_store(cache, key, fetch, encode)
+    except (redis.RedisError, sqlite3.Error, httpx.HTTPError):
+        pass
+
+async def _single_flight(key: str, fetch: Callable) -> Any:
+    task = _inflight.get(key)
+    if task is None:
+        # The fetch runs in its own task, owned by no caller, so a disconnecting client
+        # (leader or follower) only cancels its own wait and never the shared fetch
+        task = _spawn(fetch(), awaited=True)
+        _inflight[key] = task
+        task.add_done_callback(lambda done: _inflight.pop(key, None) if _inflight.get(key) is done else None)
+    return await asyncio.shield(task)
+
+async def _cache_get_or_fetch(
+    cache: SWRCache,
+    key: str,
+    fetch: Callable,
+    encode: Callable = orjson.dumps,
+    decode: Callable = orjson.loads,
+) -> tuple:
+    """Return (result, body): the result dict and its serialized JSON."""
+    entry, fresh = cache.lookup(key)
+    if entry is not None:
+        if not fresh:
+            # Within the grace period: answer now, refresh in the background
+            _spawn(_refresh(cache, key, fetch, encode, decode))
+        return entry
+    raw, fresh = await _l2_get(key)
+    if raw is not None:
+        entry = _entry(decode(raw))
+        if fresh:
+            cache.put(key, entry)
+        else:
+            # Stale-while-revalidate: answer from the stale copy and refetch in the background
+            _spawn(_refresh(cache, key, fetch, encode))
+        return entry
+
+    return await _fetch_and_store(cache, key, fetch, encode)
 
 # ----------- STATE & AGENT CLASSES -----------
 
-class WeatherState(BaseModel):
-    conversation_history: List[Dict[str, Any]] = Field(default_factory=list)
+# get_weather_report section -> agent tool method
+REPORT_SECTIONS = {
+    "current": "get_current_weather",
+    "forecast": "get_weather_forecast",
+    "air_quality": "get_air_quality",
+}
+DEFAULT_REPORT_SECTIONS = ("current", "air_quality")
+
+# Function-calling schema shared by every agent instance; treat as read-only
+WEATHER_TOOLS_SCHEMA = [
+    {
+        "type": "function",
+        "function": {
+            "name": "get_current_weather",
+            "description": "Get current weather for a location",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "location": {"type": "string", "description": "City name or coordinates"}
+                },
+                "required": ["location"]
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "get_weather_forecast",
+            "description": "Get weather forecast for a location",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "location": {"type": "string"},
+                    "days": {"type": "integer"}
+                },
+                "required": ["location"]
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "get_air_quality",
+            "description": "Get air quality index for a location",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "location": {"type": "string"}
+                },
+                "required": ["location"]
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "get_weather_report",
+            "description": "Get several kinds of weather data for a location in one call",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "location": {"type": "string"},
+                    "include": {
+                        "type": "array",
+                        "items": {"type": "string", "enum": list(REPORT_SECTIONS)},
+                        "description": "Sections to include; defaults to current and air_quality"
+                    }
+                },
+                "required": ["location"]
+            }
+        }
+    }
+]
+
+# Trusted in-process state, so a plain slotted dataclass rather than a validating
+# pydantic model; request bodies below keep pydantic.
+@dataclass(slots=True)
+class WeatherState:
+    conversation_history: deque = field(default_factory=lambda: deque(maxlen=HISTORY_MAX_ENTRIES))
     last_interaction: Optional[datetime] = None
-    saved_locations: Dict[str, Dict[str, Any]] = Field(default_factory=dict)
-    user_preferences: Dict[str, Any] = Field(default_factory=dict)
-
-    def add_to_history(self, role: str, content: str):
-        self.conversation_history.append({
+    saved_locations: Dict[str, Dict[str, Any]] = field(default_factory=dict)
+    user_preferences: Dict[str, Any] = field(default_factory=dict)
+    # Total turns seen; keeps counting after the bounded history starts dropping entries
+    conversation_count: int = 0
+
+    def add_to_history(self, role: str, content: str) -> Dict[str, Any]:
+        now = datetime.now()
+        self.conversation_count += 1
+        entry = {
             "role": role,
             "content": content,
-            "timestamp": datetime.now().isoformat()
-        })
-        self.last_interaction = datetime.now()
+            "timestamp": now.isoformat()
+        }
+        self.conversation_history.append(entry)
+        self.last_interaction = now
+        return entry
 
-    def get_recent_history(self, limit: int = 5) -> List[Dict[str, Any]]:
-        return self.conversation_history[-limit:]
+    def get_recent_history(self, limit: int = RECENT_HISTORY_LIMIT) -> List[Dict[str, Any]]:
+        # Walk from the tail so the cost is O(limit), not O(history)
+        recent = list(islice(reversed(self.conversation_history), limit))
+        recent.reverse()
+        return recent
 
     def save_location(self, location: str, data: Dict[str, Any]):
         self.saved_locations[location] = data
@@ -54,129 +634,234 @@ def tool_decorator(func: Callable) -> Callable:
     return wrapper
 
 class WeatherAgent:
-    def __init__(self, name="WeatherWise", temperature=0.7, model="gemini-2.0-flash"):
+    def __init__(
+        self,
+        name="WeatherWise",
+        temperature=0.7,
+        model="gemini-2.0-flash",
+        summarizer_model=SUMMARIZER_MODEL,
+        current_ttl=CURRENT_TTL,
+        forecast_ttl=FORECAST_TTL,
+        air_quality_ttl=AIR_QUALITY_TTL,
+    ):
         self.state = WeatherState()
         self.name = name
         self.model = model
+        self.summarizer_model = summarizer_model
         self.temperature = temperature
+        self._units = self.state.user_preferences.get("units", "metric")
+        self._last_state_sync = 0.0
+        self._current_cache = SWRCache(maxsize=1024, ttl=current_ttl)
+        self._forecast_cache = SWRCache(maxsize=1024, ttl=forecast_ttl)
+        self._air_quality_cache = SWRCache(maxsize=1024, ttl=air_quality_ttl)
         self.tools = self._register_tools()
         self.setup_agent()
+        self._tool_dispatch: Dict[str, Callable] = {
+            fn.__name__: fn
+            for fn in (self.get_current_weather, self.get_weather_forecast, self.get_air_quality, self.get_weather_report)
+        }
 
     def _register_tools(self):
-        return [
-            {
-                "type": "function",
-                "function": {
-                    "name": "get_current_weather",
-                    "description": "Get current weather for a location",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "location": {"type": "string", "description": "City name or coordinates"}
-                        },
-                        "required": ["location"]
-                    }
-                }
-            },
-            {
-                "type": "function",
-                "function": {
-                    "name": "get_weather_forecast",
-                    "description": "Get weather forecast for a location",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "location": {"type": "string"},
-                            "days": {"type": "integer"}
-                        },
-                        "required": ["location"]
-                    }
-                }
-            },
-            {
-                "type": "function",
-                "function": {
-                    "name": "get_air_quality",
-                    "description": "Get air quality index for a location",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "location": {"type": "string"}
-                        },
-                        "required": ["location"]
-                    }
-                }
-            }
-        ]
+        return WEATHER_TOOLS_SCHEMA
 
     def setup_agent(self):
         self.instructions = """You are WeatherWise, an expert weather assistant powered by Gemini.
-Your job is to provide weather, forecast, air quality, and interesting facts."""
+Your job is to provide weather, forecast, air quality, and interesting facts.
+When a question covers more than one of current weather, forecast and air quality,
+call get_weather_report once instead of the individual tools."""
+        # Static part of the system prompt, built once; only the context is appended per message
+        self._system_prefix = f"{self.instructions}\n\nContext: "
 
     def _parse_location(self, location: str) -> Dict[str, Any]:
+        return _parse_location(location)
+
+    async def process_message(self, message: str) -> str:
+        return "".join([chunk async for chunk in self.stream_message(message)])
+
+    async def stream_message(self, message: str) -> AsyncIterator[str]:
+        """Yield the reply as it is generated; only the final completion after tool calls is streamed."""
+        await self.add_to_history("user", message)
+
+        messages = [
+            {"role": "system", "content": self._system_prefix + self._serialize_context()},
+            {"role": "user", "content": message}
+        ]
+
+        response = await llm_client.chat.completions.create(
+            model=self.model,
+            messages=messages,
+            temperature=self.temperature,
+            tools=self.tools
+        )
+        response_message = response.choices[0].message
+
+        if not response_message.tool_calls:
+            response_text = response_message.content or ""
+            await self.add_to_history("assistant", response_text)
+            yield response_text
+            return
+
+        # Tool calls in one turn are independent, so run them concurrently
+        results = await asyncio.gather(*(self._call_tool(call) for call in response_message.tool_calls))
+        messages.append(response_message.model_dump(exclude_none=True))
+        for call, result in zip(response_message.tool_calls, results):
+            messages.append({"role": "tool", "tool_call_id": call.id, "content": orjson.dumps(result).decode()})
+
+        stream = await llm_client.chat.completions.create(
+            model=self.summarizer_model,
+            messages=messages,
+            temperature=self.temperature,
+            stream=True
+        )
+        parts = []
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                parts.append(delta)
+                yield delta
+        await self.add_to_history("assistant", "".join(parts))
+
+    def _serialize_context(self) -> str:
+        history = self.state.get_recent_history()
+        context = {
+            "recent_history": history,
+            "saved_locations": self.state.saved_locations,
+            "user_preferences": self.state.user_preferences
+        }
+        # Compact JSON: indentation only costs prompt tokens
+        serialized = orjson.dumps(context)
+        while len(serialized) > CONTEXT_MAX_CHARS and history:
+            del history[0]
+            serialized = orjson.dumps(context)
+        return serialized.decode()
+
+    async def _call_tool(self, call) -> Dict[str, Any]:
+        function_name = call.function.name
+        try:
+            function_args = orjson.loads(call.function.arguments or "{}")
+        except ValueError:
+            return {"error": f"Invalid arguments for {function_name}"}
+
+        handler = self._tool_dispatch.get(function_name)
+        if handler is None:
+            return {"error": f"Unknown tool: {function_name}"}
         try:
-            if "," in location:
-                lat, lon = map(float, location.split(","))
-                return {"lat": lat, "lon": lon}
-            else:
-                return {"q": location}
-        except Exception:
-            return {"q": location}
+            return await handler(**function_args)
+        except Exception as exc:
+            # Report to the model as a tool result rather than failing the whole turn
+            return {"error": f"{function_name} failed: {exc}"}
 
     @tool_decorator
-    def get_current_weather(self, location: str) -> Dict[str, Any]:
-        url = "http://api.openweathermap.org/data/2.5/weather"
-        params = self._parse_location(location)
-        params["appid"] = OPENWEATHER_API_KEY
-        params["units"] = self.state.user_preferences.get("units", "metric")
-
-        response = requests.get(url, params=params)
-        if response.status_code == 200:
-            data = response.json()
-            return {
-                "temperature": data["main"]["temp"],
-                "feels_like": data["main"]["feels_like"],
-                "humidity": data["main"]["humidity"],
-                "description": data["weather"][0]["description"],
-                "wind_speed": data["wind"]["speed"]
-            }
-        return {"error": f"Failed to get weather data: {response.status_code}"}
+    async def get_current_weather(self, location: str) -> Union[CurrentWeather, Dict[str, Any]]:
+        result, _ = await self._current_weather_entry(location)
+        return result
+
+    @tool_decorator
+    async def get_weather_forecast(self, location: str, days: int = 3) -> Dict[str, Any]:
+        result, _ = await self._weather_forecast_entry(location, days)
+        return result
+
+    @tool_decorator
+    async def get_air_quality(self, location: str) -> Dict[str, Any]:
+        result, _ = await self._air_quality_entry(location)
+        return result
 
     @tool_decorator
-    def get_weather_forecast(self, location: str, days: int = 3) -> Dict[str, Any]:
-        url = "http://api.openweathermap.org/data/2.5/forecast"
-        params = self._parse_location(location)
-        params["appid"] = OPENWEATHER_API_KEY
-        params["units"] = self.state.user_preferences.get("units", "metric")
-
-        response = requests.get(url, params=params)
-        if response.status_code == 200:
-            data = response.json()
+    async def get_weather_report(self, location: str, include: Union[List[str], str, None] = None) -> Dict[str, Any]:
+        # One tool call (and one model round-trip) for multi-part questions; sections are fetched concurrently
+        if isinstance(include, str):
+            include = [include]
+        requested = list(dict.fromkeys(include or DEFAULT_REPORT_SECTIONS))
+        sections = [s for s in requested if s in REPORT_SECTIONS]
+        results = await asyncio.gather(
+            *(getattr(self, REPORT_SECTIONS[s])(location) for s in sections), return_exceptions=True
+        )
+        # A failing section is reported on its own rather than failing the whole report
+        report = {
+            section: {"error": f"Failed to get {section}: {result}"} if isinstance(result, Exception) else result
+            for section, result in zip(sections, results)
+        }
+        for section in requested:
+            if section not in REPORT_SECTIONS:
+                report[section] = {"error": f"Unknown section: {section}"}
+        return report
+
+    # JSON-body variants for the HTTP routes; cache hits skip re-serialization entirely
+    async def get_current_weather_json(self, location: str) -> bytes:
+        _, body = await self._current_weather_entry(location)
+        return body
+
+    async def get_weather_forecast_json(self, location: str, days: int = 3) -> bytes:
+        _, body = await self._weather_forecast_entry(location, days)
+        return body
+
+    async def get_air_quality_json(self, location: str) -> bytes:
+        _, body = await self._air_quality_entry(location)
+        return body
+
+    async def _current_weather_entry(self, location: str) -> tuple:
+        key = f"ww:cur:{_normalize_location(location)}:{self._units}"
+        return await _cache_get_or_fetch(
+            self._current_cache, key, lambda: self._fetch_current_weather(location),
+            encode=_pack_current, decode=_unpack_current,
+        )
+
+    async def _weather_forecast_entry(self, location: str, days: Optional[int]) -> tuple:
+        # The full pruned forecast is cached once per location and units; `days` only slices it
+        key = f"ww:fc:{_normalize_location(location)}:{self._units}"
+        result, body = await _cache_get_or_fetch(
+            self._forecast_cache, key, lambda: self._fetch_weather_forecast(location),
+            encode=_pack_forecast, decode=_unpack_forecast,
+        )
+        if "error" in result or days is None or days >= len(result["forecast"]):
+            return result, body
+        return _entry({**result, "forecast": result["forecast"][:days]})
+
+    async def _air_quality_entry(self, location: str) -> tuple:
+        key = f"ww:aq:{_normalize_location(location)}"
+        # Geocoding happens inside the fetch, i.e. only once L1 and L2 have both missed
+        return await _cache_get_or_fetch(self._air_quality_cache, key, lambda: self._fetch_air_quality(location))
+
+    async def _fetch_current_weather(self, location: str) -> Union[CurrentWeather, Dict[str, Any]]:
+        params = {**self._parse_location(location), "units": self._units}
+        status, data = await _get_json(CURRENT_WEATHER_URL, params)
+        if status == 200:
+            main = data["main"]
+            # Rounded to the resolution _pack_current stores, so every cache layer agrees
+            return CurrentWeather(
+                temperature=round(main["temp"], 1),
+                feels_like=round(main["feels_like"], 1),
+                humidity=main["humidity"],
+                description=data["weather"][0]["description"],
+                wind_speed=round(data["wind"]["speed"], 1)
+            )
+        return {"error": f"Failed to get weather data: {status}"}
+
+    async def _fetch_weather_forecast(self, location: str) -> Dict[str, Any]:
+        params = {**self._parse_location(location), "units": self._units}
+        status, data = await _get_json(FORECAST_URL, params)
+        if status == 200:
             return {
-                "forecast": data["list"][:days],
+                "forecast": [_prune_forecast_entry(entry) for entry in data["list"]],
                 "city": data.get("city", {}).get("name", "Unknown")
             }
-        return {"error": f"Failed to get forecast data: {response.status_code}"}
+        return {"error": f"Failed to get forecast data: {status}"}
 
-    @tool_decorator
-    def get_air_quality(self, location: str) -> Dict[str, Any]:
+    async def _fetch_air_quality(self, location: str) -> Dict[str, Any]:
         coords = self._parse_location(location)
 
         if "lat" in coords and "lon" in coords:
             lat, lon = coords["lat"], coords["lon"]
         else:
-            geo_url = "http://api.openweathermap.org/geo/1.0/direct"
-            response = requests.get(geo_url, params={**coords, "limit": 1, "appid": OPENWEATHER_API_KEY})
-            if response.status_code == 200 and response.json():
-                lat, lon = response.json()[0]["lat"], response.json()[0]["lon"]
-            else:
+            resolved = await self._geocode(coords["q"])
+            if resolved is None:
                 return {"error": "Unable to resolve location to coordinates"}
+            lat, lon = round(resolved[0], COORD_PRECISION), round(resolved[1], COORD_PRECISION)
 
-        aq_url = "http://api.openweathermap.org/data/2.5/air_pollution"
-        aq_params = {"lat": lat, "lon": lon, "appid": OPENWEATHER_API_KEY}
-        aq_response = requests.get(aq_url, params=aq_params)
-        if aq_response.status_code == 200:
-            aq_data = aq_response.json()
+        _, aq_data = await _get_json(AIR_POLLUTION_URL, {"lat": lat, "lon": lon})
+        if aq_data:
             return {
                 "aqi": aq_data["list"][0]["main"]["aqi"],
                 "components": aq_data["list"][0]["components"]
@@ -184,23 +869,128 @@ Your job is to provide weather, forecast, air quality, and interesting facts."""
 
         return {"error": "Failed to get air quality data"}
 
-    def save_location(self, location: str, data: Dict[str, Any]):
+    async def _geocode(self, city: str) -> Optional[tuple]:
+        key = _normalize_location(city)
+        if key in _geocode_cache:
+            return _geocode_cache[key]
+
+        l2_key = f"ww:geo:{key}"
+
+        async def resolve():
+            raw, _ = await _l2_get(l2_key)
+            if raw is not None:
+                coords = _geocode_cache[key] = tuple(orjson.loads(raw))
+                return coords
+            _, matches = await _get_json(GEOCODING_URL, {"q": city, "limit": 1})
+            if not matches:
+                return None
+            coords = _geocode_cache[key] = (matches[0]["lat"], matches[0]["lon"])
+            await _l2_set(l2_key, orjson.dumps(coords), GEOCODE_TTL, stale_ttl=None)
+            return coords
+
+        return await _single_flight(l2_key, resolve)
+
+    # Shared state is written to Redis first and a failure propagates (redis.RedisError): applying
+    # the change only locally would be silently reverted by the next sync_state
+    async def save_location(self, location: str, data: Dict[str, Any]):
+        if redis_client is not None:
+            await redis_client.hset(SAVED_LOCATIONS_KEY, location, orjson.dumps(data))
         self.state.save_location(location, data)
 
-    def update_preferences(self, preferences: Dict[str, Any]):
+    async def update_preferences(self, preferences: Dict[str, Any]):
+        if redis_client is not None and preferences:
+            await redis_client.hset(PREFERENCES_KEY, mapping={k: orjson.dumps(v) for k, v in preferences.items()})
         self.state.user_preferences.update(preferences)
+        self._units = self.state.user_preferences.get("units", "metric")
+
+    async def add_to_history(self, role: str, content: str):
+        entry = self.state.add_to_history(role, content)
+        if redis_client is None:
+            return
+        try:
+            async with redis_client.pipeline(transaction=False) as pipe:
+                pipe.rpush(HISTORY_KEY, orjson.dumps(entry))
+                pipe.ltrim(HISTORY_KEY, -HISTORY_MAX_ENTRIES, -1)
+                pipe.incr(CONVERSATION_COUNT_KEY)
+                pipe.set(LAST_INTERACTION_KEY, entry["timestamp"])
+                await pipe.execute()
+        except redis.RedisError:
+            pass
+
+    async def sync_state(self, full: bool = False):
+        """Pull state written by other workers: preferences, and with full=True also saved
+        locations, the recent conversation and its counters.
+
+        Preferences-only syncs are throttled to one per STATE_SYNC_INTERVAL.
+        """
+        if redis_client is None:
+            return
+        now = time.monotonic()
+        if not full and now - self._last_state_sync < STATE_SYNC_INTERVAL:
+            return
+        self._last_state_sync = now
+        try:
+            async with redis_client.pipeline(transaction=False) as pipe:
+                pipe.hgetall(PREFERENCES_KEY)
+                if full:
+                    pipe.hgetall(SAVED_LOCATIONS_KEY)
+                    pipe.lrange(HISTORY_KEY, -RECENT_HISTORY_LIMIT, -1)
+                    pipe.get(CONVERSATION_COUNT_KEY)
+                    pipe.get(LAST_INTERACTION_KEY)
+                results = await pipe.execute()
+        except redis.RedisError:
+            # Keep serving this worker's local copy
+            return
+        self.state.user_preferences = {k.decode(): orjson.loads(v) for k, v in results[0].items()}
+        self._units = self.state.user_preferences.get("units", "metric")
+        if full:
+            locations, history, count, last_interaction = results[1:]
+            self.state.saved_locations = {k.decode(): orjson.loads(v) for k, v in locations.items()}
+            # The local deque only mirrors the shared tail; Redis holds the full bounded history
+            self.state.conversation_history.clear()
+            self.state.conversation_history.extend(orjson.loads(turn) for turn in history)
+            self.state.conversation_count = int(count or 0)
+            self.state.last_interaction = datetime.fromisoformat(last_interaction.decode()) if last_interaction else None
 
     def get_state_summary(self):
         return {
-            "conversation_count": len(self.state.conversation_history),
+            "conversation_count": self.state.conversation_count,
             "last_interaction": self.state.last_interaction.isoformat() if self.state.last_interaction else None,
-            "saved_locations": list(self.state.saved_locations.keys()),
+            "saved_locations": list(self.state.saved_locations),
             "preferences": self.state.user_preferences
         }
 
 # ----------- FASTAPI SETUP -----------
 
-app = FastAPI(title="WeatherWise API")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global http_client, redis_client, sqlite_cache
+    # appid rides along as a client default; retries cover dropped/refused connections only
+    http_client = httpx.AsyncClient(
+        params={"appid": OPENWEATHER_API_KEY},
+        timeout=httpx.Timeout(5.0, connect=1.0),
+        transport=httpx.AsyncHTTPTransport(
+            retries=2,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+        ),
+    )
+    if REDIS_URL:
+        redis_client = redis.Redis.from_url(REDIS_URL)
+    elif CACHE_DB_PATH:
+        # Opening runs the WAL setup and expired-row purge; keep that file I/O off the loop too
+        try:
+            sqlite_cache = await asyncio.to_thread(SQLiteCache, CACHE_DB_PATH)
+        except sqlite3.Error:
+            # e.g. a read-only working directory: run with L1 only rather than refusing to start
+            sqlite_cache = None
+    yield
+    await http_client.aclose()
+    if redis_client is not None:
+        await redis_client.aclose()
+    if sqlite_cache is not None:
+        await asyncio.to_thread(sqlite_cache.close)
+
+app = FastAPI(title="WeatherWise API", lifespan=lifespan, default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -209,6 +999,7 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(GZipMiddleware, minimum_size=512)
 
 agent = WeatherAgent()
 
@@ -216,10 +1007,16 @@ agent = WeatherAgent()
 class LocationRequest(BaseModel):
     location: str
 
+class BatchLocationRequest(BaseModel):
+    locations: List[str] = Field(max_length=50)
+
 class ForecastRequest(BaseModel):
     location: str
     days: Optional[int] = 3
 
+class ChatRequest(BaseModel):
+    message: str
+
 class PreferencesRequest(BaseModel):
     preferences: Dict[str, Any]
 
@@ -233,29 +1030,67 @@ def read_root():
     return {"message": "Welcome to WeatherWise API!"}
 
 @app.post("/weather/current")
-def current_weather(req: LocationRequest):
-    return agent.get_current_weather(req.location)
+async def current_weather(req: LocationRequest):
+    await agent.sync_state()
+    return Response(await agent.get_current_weather_json(req.location), media_type="application/json")
+
+@app.post("/weather/batch")
+async def batch_current_weather(req: BatchLocationRequest):
+    await agent.sync_state()
+    results = await asyncio.gather(
+        *(agent.get_current_weather(location) for location in req.locations),
+        return_exceptions=True,
+    )
+    return [
+        {"location": location, "data": {"error": str(result)} if isinstance(result, Exception) else result}
+        for location, result in zip(req.locations, results)
+    ]
 
 @app.post("/weather/forecast")
-def weather_forecast(req: ForecastRequest):
-    return agent.get_weather_forecast(req.location, req.days)
+async def weather_forecast(req: ForecastRequest):
+    await agent.sync_state()
+    return Response(await agent.get_weather_forecast_json(req.location, req.days), media_type="application/json")
 
 @app.post("/weather/air-quality")
-def air_quality(req: LocationRequest):
-    return agent.get_air_quality(req.location)
+async def air_quality(req: LocationRequest):
+    await agent.sync_state()
+    return Response(await agent.get_air_quality_json(req.location), media_type="application/json")
+
+@app.post("/chat")
+async def chat(req: ChatRequest):
+    await agent.sync_state(full=True)
+    return {"response": await agent.process_message(req.message)}
+
+async def _sse_events(chunks: AsyncIterator[str]) -> AsyncIterator[str]:
+    # One server-sent event per chunk; multi-line chunks become multiple data lines
+    async for chunk in chunks:
+        yield "".join(f"data: {line}\n" for line in chunk.split("\n")) + "\n"
+
+@app.post("/chat/stream")
+async def chat_stream(req: ChatRequest):
+    await agent.sync_state(full=True)
+    # text/event-stream is exempt from GZipMiddleware, which would otherwise buffer until the end
+    return StreamingResponse(_sse_events(agent.stream_message(req.message)), media_type="text/event-stream")
 
 @app.post("/preferences")
-def update_preferences(req: PreferencesRequest):
-    agent.update_preferences(req.preferences)
+async def update_preferences(req: PreferencesRequest):
+    try:
+        await agent.update_preferences(req.preferences)
+    except redis.RedisError:
+        raise HTTPException(status_code=503, detail="Preferences could not be saved; please retry.")
     return {"message": "Preferences updated."}
 
 @app.post("/locations")
-def save_location(req: SaveLocationRequest):
-    agent.save_location(req.name, req.data)
+async def save_location(req: SaveLocationRequest):
+    try:
+        await agent.save_location(req.name, req.data)
+    except redis.RedisError:
+        raise HTTPException(status_code=503, detail=f"Location '{req.name}' could not be saved; please retry.")
     return {"message": f"Location '{req.name}' saved."}
 
 @app.get("/agent/state")
-def agent_state():
+async def agent_state():
+    await agent.sync_state(full=True)
     return agent.get_state_summary()
 
 
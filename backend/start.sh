@@ -0,0 +1,25 @@
+#!/usr/bin/env sh
+# Production launch: uvicorn on uvloop + httptools, one worker per core when Redis is configured.
+cd "$(dirname "$0")"
+
+# main.py also reads REDIS_URL from .env, so look there when it is not exported
+REDIS_URL="${REDIS_URL:-$(sed -n 's/^REDIS_URL=//p' .env 2>/dev/null | tr -d '"'"'"'')}"
+
+# Without Redis every worker keeps its own preferences, saved locations and chat history,
+# so more than one worker would give each request a different view of the agent state
+if [ -n "$REDIS_URL" ]; then
+    WORKERS="${WEB_CONCURRENCY:-$(nproc)}"
+else
+    WORKERS="${WEB_CONCURRENCY:-1}"
+    if [ "$WORKERS" -gt 1 ]; then
+        echo "start.sh: WEB_CONCURRENCY=$WORKERS needs REDIS_URL so workers share agent state" >&2
+        exit 1
+    fi
+fi
+
+exec uvicorn main:app \
+    --host 0.0.0.0 \
+    --port "${PORT:-8080}" \
+    --workers "$WORKERS" \
+    --loop uvloop \
+    --http httptools
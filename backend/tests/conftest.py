@@ -0,0 +1,83 @@
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+# main reads its configuration at import time; keep tests off Redis and off the on-disk cache
+os.environ.setdefault("GEMINI_API_KEY", "test")
+os.environ.setdefault("OPENWEATHER_API_KEY", "test")
+os.environ["REDIS_URL"] = ""
+os.environ["CACHE_DB_PATH"] = ""
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import httpx
+import pytest
+from aiolimiter import AsyncLimiter
+
+import main
+
+FORECAST_ENTRIES = 40
+
+
+class FakeOpenWeather:
+    """Stands in for the OpenWeather API through httpx.MockTransport and records every request."""
+
+    def __init__(self):
+        self.calls = []
+        self.status = 200
+        # Answer this many upcoming requests with 503 before going back to `status`
+        self.fail_next = 0
+        self.delay = 0.0
+
+    async def handler(self, request: httpx.Request) -> httpx.Response:
+        self.calls.append(request.url.path)
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if self.fail_next:
+            self.fail_next -= 1
+            return httpx.Response(503)
+        if self.status != 200:
+            return httpx.Response(self.status)
+        path = request.url.path
+        if path.endswith("/weather"):
+            return httpx.Response(200, json={
+                "main": {"temp": 12.34, "feels_like": 11.2, "humidity": 80},
+                "weather": [{"description": "light rain"}],
+                "wind": {"speed": 3.6},
+            })
+        if path.endswith("/forecast"):
+            return httpx.Response(200, json={
+                "list": [
+                    {"dt": 1700000000 + i * 10800, "main": {"temp": 10.0 + i, "feels_like": 9.0, "humidity": 70, "pressure": 1000},
+                     "weather": [{"main": "Clouds", "description": "overcast", "icon": "04d", "id": 804}],
+                     "wind": {"speed": 2.5, "deg": 100}}
+                    for i in range(FORECAST_ENTRIES)
+                ],
+                "city": {"name": "London"},
+            })
+        if path.endswith("/direct"):
+            return httpx.Response(200, json=[{"lat": 51.50735, "lon": -0.12776}])
+        if path.endswith("/air_pollution"):
+            return httpx.Response(200, json={"list": [{"main": {"aqi": 2}, "components": {"pm2_5": 5.0}}]})
+        return httpx.Response(404)
+
+
+@pytest.fixture(autouse=True)
+def fresh_state(monkeypatch):
+    """Every test starts with empty caches, closed breakers, a full call budget and no second cache layer."""
+    monkeypatch.setattr(main, "_last_responses", main.TTLCache(maxsize=2048, ttl=main.STALE_TTL))
+    monkeypatch.setattr(main, "_inflight", {})
+    monkeypatch.setattr(main, "_upstream_breakers", {url: main.CircuitBreaker() for url in main._upstream_breakers})
+    monkeypatch.setattr(main, "_upstream_limiter", AsyncLimiter(main.OPENWEATHER_CALLS_PER_MINUTE, 60))
+    monkeypatch.setattr(main, "RETRY_BACKOFF", 0)
+    monkeypatch.setattr(main, "redis_client", None)
+    monkeypatch.setattr(main, "sqlite_cache", None)
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    fake = FakeOpenWeather()
+    client = httpx.AsyncClient(transport=httpx.MockTransport(fake.handler))
+    monkeypatch.setattr(main, "http_client", client)
+    yield fake
+    asyncio.run(client.aclose())
@@ -0,0 +1,89 @@
+import asyncio
+import time
+
+import main
+
+PARAMS = {"q": "London", "units": "metric"}
+
+
+def _trip(url: str):
+    breaker = main._upstream_breakers[url]
+    for _ in range(breaker.fail_max):
+        breaker.record_failure()
+
+
+def test_open_breaker_serves_last_good_body(upstream):
+    async def run():
+        first = await main._get_json(main.CURRENT_WEATHER_URL, PARAMS)
+        _trip(main.CURRENT_WEATHER_URL)
+        upstream.status = 500
+        second = await main._get_json(main.CURRENT_WEATHER_URL, PARAMS)
+        return first, second, main._served_stale.get()
+
+    first, second, served_stale = asyncio.run(run())
+    assert second == first
+    assert served_stale
+    assert len(upstream.calls) == 1
+
+
+def test_open_breaker_without_previous_body_returns_503(upstream):
+    _trip(main.CURRENT_WEATHER_URL)
+    assert asyncio.run(main._get_json(main.CURRENT_WEATHER_URL, PARAMS)) == (503, None)
+    assert not upstream.calls
+
+
+def test_agent_answers_from_stale_body_without_caching_it(upstream):
+    warm, cold = main.WeatherAgent(), main.WeatherAgent()
+
+    async def run():
+        fresh = await warm.get_current_weather("London")
+        _trip(main.CURRENT_WEATHER_URL)
+        return fresh, await cold.get_current_weather("London")
+
+    fresh, stale = asyncio.run(run())
+    assert stale == fresh
+    assert len(upstream.calls) == 1
+    assert len(cold._current_cache) == 0
+
+
+def test_breakers_are_per_endpoint(upstream):
+    _trip(main.AIR_POLLUTION_URL)
+    status, _ = asyncio.run(main._get_json(main.FORECAST_URL, PARAMS))
+    assert status == 200
+    assert len(upstream.calls) == 1
+
+
+def test_repeated_failures_open_the_breaker(upstream):
+    upstream.status = 500
+    breaker = main._upstream_breakers[main.CURRENT_WEATHER_URL]
+
+    async def run():
+        for _ in range(breaker.fail_max):
+            await main._get_json(main.CURRENT_WEATHER_URL, PARAMS)
+
+    asyncio.run(run())
+    assert not breaker.allow_request()
+
+
+def test_half_open_lets_a_single_probe_through():
+    breaker = main.CircuitBreaker(fail_max=1, reset_timeout=0.05)
+    breaker.record_failure()
+    assert not breaker.allow_request()
+
+    time.sleep(0.06)
+    assert breaker.allow_request()
+    assert not breaker.allow_request()
+    breaker.record_success()
+    assert breaker.allow_request()
+
+
+def test_failed_probe_reopens_the_breaker():
+    breaker = main.CircuitBreaker(fail_max=5, reset_timeout=0.05)
+    for _ in range(5):
+        breaker.record_failure()
+
+    time.sleep(0.06)
+    assert breaker.allow_request()
+    # A single probe failure is enough, regardless of fail_max
+    breaker.record_failure()
+    assert not breaker.allow_request()
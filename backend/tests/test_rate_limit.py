@@ -0,0 +1,49 @@
+import asyncio
+
+from aiolimiter import AsyncLimiter
+
+import main
+
+PARAMS = {"q": "London", "units": "metric"}
+
+
+def test_spent_budget_serves_previous_body_without_waiting(upstream, monkeypatch):
+    monkeypatch.setattr(main, "_upstream_limiter", AsyncLimiter(1, 60))
+
+    async def run():
+        first = await main._get_json(main.CURRENT_WEATHER_URL, PARAMS)
+        # With the budget spent, waiting on the limiter would take a minute
+        second = await asyncio.wait_for(main._get_json(main.CURRENT_WEATHER_URL, PARAMS), timeout=1)
+        return first, second, main._served_stale.get()
+
+    first, second, served_stale = asyncio.run(run())
+    assert second == first
+    assert served_stale
+    assert len(upstream.calls) == 1
+
+
+def test_retries_spend_one_token(upstream, monkeypatch):
+    monkeypatch.setattr(main, "_upstream_limiter", AsyncLimiter(2, 60))
+    upstream.fail_next = 2
+
+    async def run():
+        status, _ = await asyncio.wait_for(main._get_json(main.CURRENT_WEATHER_URL, PARAMS), timeout=1)
+        return status, main._upstream_limiter.has_capacity()
+
+    status, has_capacity = asyncio.run(run())
+    assert status == 200
+    assert len(upstream.calls) == 3
+    assert has_capacity
+
+
+def test_stale_result_is_not_cached(upstream, monkeypatch):
+    monkeypatch.setattr(main, "_upstream_limiter", AsyncLimiter(1, 60))
+    warm, cold = main.WeatherAgent(), main.WeatherAgent()
+
+    async def run():
+        await warm.get_current_weather("London")
+        return await cold.get_current_weather("London")
+
+    assert isinstance(asyncio.run(run()), main.CurrentWeather)
+    assert len(upstream.calls) == 1
+    assert len(cold._current_cache) == 0
@@ -0,0 +1,50 @@
+import asyncio
+
+import main
+
+
+def test_concurrent_misses_share_one_upstream_call(upstream):
+    upstream.delay = 0.05
+    agent = main.WeatherAgent()
+
+    async def run():
+        # Spelling variants normalize to the same key and join the same fetch
+        locations = ["London", " london ", "LONDON"] * 4
+        return await asyncio.gather(*(agent.get_current_weather(loc) for loc in locations))
+
+    results = asyncio.run(run())
+    assert len(upstream.calls) == 1
+    assert all(result == results[0] for result in results)
+    assert not main._inflight
+
+
+def test_cancelled_caller_does_not_cancel_shared_fetch(upstream):
+    upstream.delay = 0.05
+    agent = main.WeatherAgent()
+
+    async def run():
+        leader = asyncio.create_task(agent.get_current_weather("London"))
+        follower = asyncio.create_task(agent.get_current_weather("London"))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        return await follower
+
+    result = asyncio.run(run())
+    assert isinstance(result, main.CurrentWeather)
+    assert len(upstream.calls) == 1
+
+
+def test_failed_fetch_is_shared_but_not_cached(upstream):
+    upstream.status = 404
+    agent = main.WeatherAgent()
+
+    async def run():
+        failed = await asyncio.gather(*(agent.get_current_weather("London") for _ in range(5)))
+        upstream.status = 200
+        return failed, await agent.get_current_weather("London")
+
+    failed, retried = asyncio.run(run())
+    assert all(result == {"error": "Failed to get weather data: 404"} for result in failed)
+    assert isinstance(retried, main.CurrentWeather)
+    assert len(upstream.calls) == 2
+
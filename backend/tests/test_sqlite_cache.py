@@ -0,0 +1,53 @@
+import asyncio
+
+import main
+
+
+def test_values_survive_reopening(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = main.SQLiteCache(path)
+    cache.set("fresh", b"a", ttl=60, stale_ttl=120)
+    cache.set("stale", b"b", ttl=0, stale_ttl=120)
+    cache.set("pinned", b"c", ttl=60, stale_ttl=None)
+    cache.close()
+
+    cache = main.SQLiteCache(path)
+    try:
+        assert cache.get("fresh") == (b"a", True)
+        assert cache.get("stale") == (b"b", False)
+        assert cache.get("pinned") == (b"c", True)
+        assert cache.get("missing") == (None, False)
+    finally:
+        cache.close()
+
+
+def test_expired_rows_are_purged_on_open(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = main.SQLiteCache(path)
+    cache.set("gone", b"a", ttl=0, stale_ttl=-1)
+    cache.close()
+
+    cache = main.SQLiteCache(path)
+    try:
+        assert cache._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0] == 0
+    finally:
+        cache.close()
+
+
+def test_restarted_worker_answers_from_disk(tmp_path, upstream, monkeypatch):
+    path = str(tmp_path / "cache.sqlite")
+
+    async def run_worker():
+        # A fresh agent and connection stand in for a restarted process with an empty L1
+        monkeypatch.setattr(main, "sqlite_cache", main.SQLiteCache(path))
+        try:
+            agent = main.WeatherAgent()
+            return await agent.get_current_weather("London"), await agent.get_weather_forecast("London", days=2)
+        finally:
+            main.sqlite_cache.close()
+
+    before = asyncio.run(run_worker())
+    main._last_responses.clear()
+    after = asyncio.run(run_worker())
+    assert after == before
+    assert len(upstream.calls) == 2